@@ -1,18 +1,20 @@
 import json
 import os
-from typing import List, Optional, Tuple, Union
+from dataclasses import dataclass
+from functools import cached_property
+from typing import TYPE_CHECKING, List, Optional, Tuple, Union
 
-import cartopy.io.shapereader as shpreader
-import geopandas as gpd
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import rasterio as rio
 from osgeo import gdal
+from pandas.compat._optional import import_optional_dependency
 from rasterio import transform
 from rasterio.mask import mask
 from shapely.geometry import box
-from sklearn.metrics import confusion_matrix
+
+if TYPE_CHECKING:
+    import geopandas as gpd
 
 
 def gdal_reproject(target_crs: str, source_crs: str, source_fn: str, dest_fn: str) -> None:
@@ -32,12 +34,14 @@ def gdal_cutline(
     os.system(cmd)
 
 
-def load_ne(country_code: str, regions_of_interest: List[str]) -> gpd.GeoDataFrame:
+def load_ne(country_code: str, regions_of_interest: List[str]) -> "gpd.GeoDataFrame":
     """
     Load the Natural Earth country and region shapefiles.
     country_code: ISO 3166-1 alpha-3 country code
     regions_of_interest: list of regions of interest
     """
+    gpd = import_optional_dependency("geopandas")
+    shpreader = import_optional_dependency("cartopy.io.shapereader")
 
     ne_shapefile = shpreader.natural_earth(
         resolution="10m", category="cultural", name="admin_1_states_provinces"
@@ -81,7 +85,7 @@ def load_ne(country_code: str, regions_of_interest: List[str]) -> gpd.GeoDataFra
 
 
 def clip_raster(
-    in_raster: str, boundary: Optional[gpd.GeoDataFrame] = None
+    in_raster: str, boundary: Optional["gpd.GeoDataFrame"] = None
 ) -> Tuple[Optional[np.ma.core.MaskedArray], dict]:
     """Clip the raster to the boundary
     in_raster: path to the input raster
@@ -90,6 +94,7 @@ def clip_raster(
     with rio.open(in_raster) as src:
         if boundary is None:
             print("No boundary provided. Clipping to map bounds.")
+            gpd = import_optional_dependency("geopandas")
             boundary = gpd.GeoDataFrame(geometry=[box(*src.bounds)], crs=src.crs)
 
         else:
@@ -115,7 +120,7 @@ def clip_raster(
 
 
 def load_raster(
-    in_raster: str, boundary: Optional[gpd.GeoDataFrame] = None
+    in_raster: str, boundary: Optional["gpd.GeoDataFrame"] = None
 ) -> Tuple[Optional[np.ma.core.MaskedArray], dict]:
     """
     Check if the raster is projected in the correct CRS.
@@ -225,6 +230,7 @@ def random_inds(
 
 
 def generate_ref_samples(binary_map: np.ndarray, meta: dict, n_crop: int, n_noncrop: int) -> None:
+    gpd = import_optional_dependency("geopandas")
     df_noncrop = pd.DataFrame([], columns=["px", "py", "pred_class"])
     df_noncrop["px"], df_noncrop["py"] = random_inds(binary_map, 0, int(n_noncrop))
     df_noncrop["pred_class"] = 0
@@ -254,7 +260,8 @@ def generate_ref_samples(binary_map: np.ndarray, meta: dict, n_crop: int, n_nonc
 
 def reference_sample_agree(
     binary_map: np.ndarray, meta: dict, ceo_ref1: str, ceo_ref2: str
-) -> gpd.GeoDataFrame:
+) -> "gpd.GeoDataFrame":
+    gpd = import_optional_dependency("geopandas")
     ceo_set1 = pd.read_csv(ceo_ref1)
     ceo_set2 = pd.read_csv(ceo_ref2)
 
@@ -332,7 +339,7 @@ def reference_sample_agree(
     return ceo_agree_geom
 
 
-def compute_confusion_matrix(df: Union[pd.DataFrame, gpd.GeoDataFrame]) -> np.ndarray:
+def compute_confusion_matrix(df: Union[pd.DataFrame, "gpd.GeoDataFrame"]) -> np.ndarray:
     """Computes confusion matrix of reference and map samples.
 
     Returns confusion matrix in row 'Truth' and column 'Prediction' order.
@@ -341,11 +348,53 @@ def compute_confusion_matrix(df: Union[pd.DataFrame, gpd.GeoDataFrame]) -> np.nd
 
     y_true = np.array(df["Reference label"]).astype(np.uint8)
     y_pred = np.array(df["Mapped class"]).astype(np.uint8)
-    cm = confusion_matrix(y_true, y_pred)
-    return cm
+    # Same label set as sklearn's confusion_matrix: sorted union of both arrays
+    # (may include 255 for reference samples without agreement)
+    labels = np.union1d(y_true, y_pred)
+    n = len(labels)
+    i = np.searchsorted(labels, y_true).astype(np.int64)
+    j = np.searchsorted(labels, y_pred).astype(np.int64)
+    return np.bincount(i * n + j, minlength=n * n).reshape(n, n)
+
+
+@dataclass(frozen=True, eq=False)
+class ConfusionStats:
+    """Matrix of reference and map samples with its diagonal and marginal totals.
+
+    Each aggregate is computed on first use and then reused, so functions called back
+    to back on the same matrix don't sum it again. Works for both the confusion matrix
+    of sample counts, n[i,j], and the error matrix of area proportions, p[i,j].
+
+    Args:
+        cm:
+            Matrix ordered reference-row, map-column.
+
+    """
+
+    cm: np.ndarray
+
+    @cached_property
+    def col_sum(self) -> np.ndarray:
+        return self.cm.sum(axis=0)
 
+    @cached_property
+    def row_sum(self) -> np.ndarray:
+        return self.cm.sum(axis=1)
 
-def compute_area_error_matrix(cm: np.ndarray, w_j: np.ndarray) -> np.ndarray:
+    @cached_property
+    def diag(self) -> np.ndarray:
+        return np.diagonal(self.cm)
+
+    @cached_property
+    def total(self) -> float:
+        return self.cm.sum()
+
+
+def _as_stats(cm: Union[np.ndarray, ConfusionStats]) -> ConfusionStats:
+    return cm if isinstance(cm, ConfusionStats) else ConfusionStats(np.asarray(cm))
+
+
+def compute_area_error_matrix(cm: Union[np.ndarray, ConfusionStats], w_j: np.ndarray) -> np.ndarray:
     """Computes error matrix in terms of area proportion, p[i,j].
 
     Args:
@@ -360,14 +409,14 @@ def compute_area_error_matrix(cm: np.ndarray, w_j: np.ndarray) -> np.ndarray:
 
     """
 
-    n_dotj = cm.sum(axis=0)
-    area_matrix = (w_j * cm) / n_dotj
+    stats = _as_stats(cm)
+    area_matrix = (w_j * stats.cm) / stats.col_sum
     # if no predictions for class j, n_dotj will be 0
     area_matrix[np.where(np.isnan(area_matrix))] = 0
     return area_matrix
 
 
-def compute_u_j(am: np.ndarray) -> np.ndarray:
+def compute_u_j(am: Union[np.ndarray, ConfusionStats]) -> np.ndarray:
     """Computes the user's accuracy of mapped classes.
 
     Args:
@@ -380,15 +429,14 @@ def compute_u_j(am: np.ndarray) -> np.ndarray:
 
     """
 
-    p_jjs = np.diag(am)
-    p_dotjs = am.sum(axis=0)
-    u_j = p_jjs / p_dotjs
+    stats = _as_stats(am)
+    u_j = stats.diag / stats.col_sum
     # if no predictions for class j, p_dotj will be 0
     u_j[np.where(np.isnan(u_j))] = 0
     return u_j
 
 
-def compute_var_u_j(u_j: np.ndarray, cm: np.ndarray) -> np.ndarray:
+def compute_var_u_j(u_j: np.ndarray, cm: Union[np.ndarray, ConfusionStats]) -> np.ndarray:
     """Estimates the variance of user's accuracy of mapped classes.
 
     Args:
@@ -404,11 +452,11 @@ def compute_var_u_j(u_j: np.ndarray, cm: np.ndarray) -> np.ndarray:
 
     """
 
-    n_dotj = cm.sum(axis=0)
+    n_dotj = _as_stats(cm).col_sum
     return u_j * (1 - u_j) / (n_dotj - 1)
 
 
-def compute_p_i(am: np.ndarray) -> np.ndarray:
+def compute_p_i(am: Union[np.ndarray, ConfusionStats]) -> np.ndarray:
     """Computes the producer's accuracy of reference classes.
 
     Args:
@@ -421,13 +469,12 @@ def compute_p_i(am: np.ndarray) -> np.ndarray:
 
     """
 
-    p_iis = np.diag(am)
-    p_idots = am.sum(axis=1)
-    return p_iis / p_idots
+    stats = _as_stats(am)
+    return stats.diag / stats.row_sum
 
 
 def compute_var_p_i(
-    p_i: np.ndarray, u_j: np.ndarray, a_j: np.ndarray, cm: np.ndarray
+    p_i: np.ndarray, u_j: np.ndarray, a_j: np.ndarray, cm: Union[np.ndarray, ConfusionStats]
 ) -> np.ndarray:
     """Estimates the variance of producer's accuracy of reference classes.
 
@@ -450,29 +497,31 @@ def compute_var_p_i(
 
     """
 
+    stats = _as_stats(cm)
+
+    # Total number of sample units of mapped class
+    n_j_su = stats.col_sum
+
     # Estimated marginal total of pixels of reference class
-    n_i_px = ((a_j / cm.sum(axis=0) * cm).sum(axis=1)).astype(np.uint64)
+    n_i_px = ((a_j / n_j_su * stats.cm).sum(axis=1)).astype(np.uint64)
 
     # Marginal total number of pixels of mapped class
     n_j_px = a_j.astype(np.uint64)
-
-    # Total number of sample units of mapped class
-    n_j_su = cm.sum(axis=0)
+    weight_j = n_j_px**2 / (n_j_su - 1)
 
     # Confusion matrix divided by total number of sample units per mapped class
-    cm_div = cm / n_j_su
+    cm_div = stats.cm / n_j_su
     # if no predictions for class j, n_j_su will be 0
-    cm_div[np.where(np.isnan(cm_div))] = 0
-    cm_div_comp = 1 - cm_div
+    np.nan_to_num(cm_div, copy=False, nan=0.0)
 
-    # We fill the diagonals to '0' because of summation condition that i =/= j
-    # in the second expression of equation
+    # We fill the diagonal to '0' because of summation condition that i =/= j
+    # in the second expression of equation; this also zeroes the diagonal of
+    # the product, so the complement needs no separate copy
     np.fill_diagonal(cm_div, 0.0)
-    np.fill_diagonal(cm_div_comp, 0.0)
 
-    sigma = ((n_j_px**2) * (cm_div) * (cm_div_comp) / (n_j_su - 1)).sum(axis=1)
+    sigma = np.einsum("j,ij,ij->i", weight_j, cm_div, 1 - cm_div)
     expr_2 = (p_i**2) * sigma
-    expr_1 = (n_j_px**2) * ((1 - p_i) ** 2) * u_j * (1 - u_j) / (n_j_su - 1)
+    expr_1 = weight_j * ((1 - p_i) ** 2) * u_j * (1 - u_j)
     expr_3 = 1 / n_i_px**2
     # convert inf to 0 (can result from divide by 0)
     expr_3[np.where(np.isinf(expr_3))] = 0
@@ -480,7 +529,7 @@ def compute_var_p_i(
     return expr_3 * (expr_1 + expr_2)
 
 
-def compute_acc(am: np.ndarray) -> float:
+def compute_acc(am: Union[np.ndarray, ConfusionStats]) -> float:
     """Computes the overall accuracy.
 
     Args:
@@ -490,11 +539,13 @@ def compute_acc(am: np.ndarray) -> float:
 
     """
 
-    acc = np.diag(am).sum()
+    acc = _as_stats(am).diag.sum()
     return acc
 
 
-def compute_var_acc(w_j: np.ndarray, u_j: np.ndarray, cm: np.ndarray) -> float:
+def compute_var_acc(
+    w_j: np.ndarray, u_j: np.ndarray, cm: Union[np.ndarray, ConfusionStats]
+) -> float:
     """Estimates the variance of overall accuracy.
 
     Args:
@@ -508,11 +559,15 @@ def compute_var_acc(w_j: np.ndarray, u_j: np.ndarray, cm: np.ndarray) -> float:
 
     """
 
-    sigma = (w_j**2) * (u_j) * (1 - u_j) / (cm.sum(axis=0) - 1)
+    sigma = (w_j**2) * (u_j) * (1 - u_j) / (_as_stats(cm).col_sum - 1)
     return sigma.sum()
 
 
-def compute_std_p_i(w_j: np.ndarray, am: np.ndarray, cm: np.ndarray) -> np.ndarray:
+def compute_std_p_i(
+    w_j: np.ndarray,
+    am: Union[np.ndarray, ConfusionStats],
+    cm: Union[np.ndarray, ConfusionStats],
+) -> np.ndarray:
     """Estimates the standard error of area estimator, p_{i.}.
 
     Args:
@@ -532,7 +587,8 @@ def compute_std_p_i(w_j: np.ndarray, am: np.ndarray, cm: np.ndarray) -> np.ndarr
 
     """
 
-    sigma = (w_j * am - am**2) / (cm.sum(axis=0) - 1)
+    am = _as_stats(am).cm
+    sigma = (w_j * am - am**2) / (_as_stats(cm).col_sum - 1)
     return np.sqrt(sigma.sum(axis=1))
 
 
@@ -564,26 +620,28 @@ def compute_area_estimate(cm: np.ndarray, a_j: np.ndarray, px_size: float) -> di
 
     w_j = a_j / total_px
 
-    am = compute_area_error_matrix(cm, w_j)
+    # Diagonal and marginal totals of both matrices are computed once and shared
+    stats = ConfusionStats(cm)
+    am = ConfusionStats(compute_area_error_matrix(stats, w_j))
 
     # User's accuracy
     u_j = compute_u_j(am)
-    var_u_j = compute_var_u_j(u_j, cm)
+    var_u_j = compute_var_u_j(u_j, stats)
     err_u_j = 1.96 * np.sqrt(var_u_j)
 
     # Producer's accuracy
     p_i = compute_p_i(am)
-    var_p_i = compute_var_p_i(p_i, u_j, a_j, cm)
+    var_p_i = compute_var_p_i(p_i, u_j, a_j, stats)
     err_p_i = 1.96 * np.sqrt(var_p_i)
 
     # Overall accuracy
     acc = compute_acc(am)
-    var_acc = compute_var_acc(w_j, u_j, cm)
+    var_acc = compute_var_acc(w_j, u_j, stats)
     err_acc = 1.96 * np.sqrt(var_acc)
 
     # Area estimate
-    a_i = am.sum(axis=1)
-    std_a_i = compute_std_p_i(w_j, am, cm)
+    a_i = am.row_sum
+    std_a_i = compute_std_p_i(w_j, am, stats)
     err_a_i = 1.96 * std_a_i
 
     # Adjusted marginal area estimate in [px] and [ha]
@@ -668,7 +726,7 @@ def create_area_estimate_summary(
 
 
 def create_confusion_matrix_summary(
-    cm: np.ndarray, columns: Union[List[str], np.ndarray]
+    cm: Union[np.ndarray, ConfusionStats], columns: Union[List[str], np.ndarray]
 ) -> pd.DataFrame:
     """Generates summary table of confusion matrix.
 
@@ -692,10 +750,11 @@ def create_confusion_matrix_summary(
 
     """
 
-    fp = cm.sum(axis=0) - np.diag(cm)  # Column-wise (Prediction)
-    fn = cm.sum(axis=1) - np.diag(cm)  # Row-wise (Truth)
-    tp = np.diag(cm)  # Diagonals (Prediction and Truth)
-    tn = cm.sum() - (fp + fn + tp)
+    stats = _as_stats(cm)
+    tp = stats.diag  # Diagonals (Prediction and Truth)
+    fp = stats.col_sum - tp  # Column-wise (Prediction)
+    fn = stats.row_sum - tp  # Row-wise (Truth)
+    tn = stats.total - (fp + fn + tp)
 
     fpr = fp / (fp + tn)
     tpr = tp / (tp + fn)
@@ -711,6 +770,7 @@ def create_confusion_matrix_summary(
 
 
 def plot_area(summary: pd.DataFrame) -> None:
+    plt = import_optional_dependency("matplotlib.pyplot")
     area_class = summary.columns
     x_pos = np.arange(len(area_class))
     est_area = summary.loc["Estimated area [ha]"]
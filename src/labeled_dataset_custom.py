@@ -1,9 +1,18 @@
+import functools
+import multiprocessing
+import random
 import tempfile
+import time
 from dataclasses import dataclass
-from typing import List, Tuple
+from datetime import date
+from pathlib import Path
+from typing import Any, List, Optional, Set, Tuple
 
+import numpy as np
 import pandas as pd
-from openmapflow.config import PROJECT_ROOT
+import requests
+from openmapflow.bbox import BBox
+from openmapflow.config import DATA_DIR, GCLOUD_LOCATION, PROJECT_ROOT, BucketNames
 from openmapflow.config import DataPaths as dp
 from openmapflow.constants import (
     CLASS_PROB,
@@ -15,6 +24,11 @@ from openmapflow.constants import (
     EO_LAT,
     EO_LON,
     EO_STATUS,
+    EO_STATUS_COMPLETE,
+    EO_STATUS_DUPLICATE,
+    EO_STATUS_EXPORT_FAILED,
+    EO_STATUS_EXPORTING,
+    EO_STATUS_MISSING_VALUES,
     EO_STATUS_SKIPPED,
     LABEL_DUR,
     LABELER_NAMES,
@@ -25,15 +39,306 @@ from openmapflow.constants import (
     START,
     SUBSET,
 )
+from openmapflow.ee_exporter import (
+    EarthEngineAPI,
+    EarthEngineExporter,
+    get_cloud_tif_list,
+)
 from openmapflow.labeled_dataset import (
     LabeledDataset,
+    _find_matching_point,
+    _find_matching_point_url,
     _label_eo_counts,
+    clean_df_condition,
     get_label_timesteps,
 )
+from openmapflow.utils import tqdm
+from pandas.compat._optional import import_optional_dependency
 
 from src.raw_labels import RawLabels
 
 temp_dir = tempfile.gettempdir()
+eo_bboxes_cache_path = PROJECT_ROOT / DATA_DIR / "eo_bboxes.csv"
+
+# The high volume endpoint is meant for many parallel requests
+EE_API_PROCESSES = 25
+EE_API_MAX_RETRIES = 5
+ee_api: Optional[EarthEngineAPI] = None
+
+# Column types of the processed labels csv, so they are not inferred again on every read
+labels_dtypes = {
+    SOURCE: str,
+    CLASS_PROB: "float64",
+    START: str,
+    END: str,
+    LON: "float64",
+    LAT: "float64",
+    SUBSET: str,
+    LABELER_NAMES: str,
+    LABEL_DUR: str,
+    EO_DATA: str,
+    EO_LAT: "float64",
+    EO_LON: "float64",
+    EO_FILE: str,
+    EO_STATUS: str,
+    NUM_LABELERS: "Int64",
+    COUNTRY: str,
+    DATASET: str,
+}
+
+
+def _read_labels(path: Path) -> pd.DataFrame:
+    return pd.read_csv(path, dtype=labels_dtypes)
+
+
+@dataclass
+class EOFileBBoxes:
+    """
+    Bounding boxes of all earth observation files stored column-wise, together with
+    an STRtree spatial index over the boxes so labels only get tested against the
+    few files near them.
+    """
+
+    paths: np.ndarray
+    start_dates: np.ndarray
+    end_dates: np.ndarray
+    min_lat: np.ndarray
+    max_lat: np.ndarray
+    min_lon: np.ndarray
+    max_lon: np.ndarray
+    tree: Any
+
+
+def _date_key(uri: str) -> str:
+    # ".../min_lat=..._dates=2019-01-01_2020-12-31_all.tif" -> "2019-01-01_2020-12-31"
+    return "_".join(Path(uri).stem.split("dates=")[-1].split("_")[:2])
+
+
+def _parse_bboxes(uris: List[str]) -> pd.DataFrame:
+    bboxes = [BBox.from_str(uri) for uri in tqdm(uris, desc="Generating BBoxes from paths")]
+    return pd.DataFrame(
+        {
+            "path": uris,
+            "date_key": [_date_key(uri) for uri in uris],
+            "min_lat": [b.min_lat for b in bboxes],
+            "max_lat": [b.max_lat for b in bboxes],
+            "min_lon": [b.min_lon for b in bboxes],
+            "max_lon": [b.max_lon for b in bboxes],
+        }
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def _generate_bbox_from_paths() -> EOFileBBoxes:
+    """
+    Bounding boxes are parsed from the tif names, which never change once exported,
+    so they are cached on disk and only newly exported tifs are parsed on each run.
+    Within a run the bucket is listed and the STRtree is built once.
+    """
+    shapely = import_optional_dependency("shapely", min_version="2.0")
+    cloud_eo_uris = get_cloud_tif_list(BucketNames.LABELED_EO, region=GCLOUD_LOCATION)
+
+    cached = pd.DataFrame(columns=["path"])
+    if eo_bboxes_cache_path.exists():
+        cached = pd.read_csv(
+            eo_bboxes_cache_path, dtype={"path": str, "date_key": str}, float_precision="round_trip"
+        )
+    cached_uris = set(cached["path"])
+    new = _parse_bboxes([uri for uri in cloud_eo_uris if uri not in cached_uris])
+    if len(new) > 0:
+        new.to_csv(
+            eo_bboxes_cache_path, mode="a", header=not eo_bboxes_cache_path.exists(), index=False
+        )
+
+    # Tifs removed from the bucket may still be in the cache
+    bbox_df = pd.concat([cached, new]).drop_duplicates("path").set_index("path")
+    bbox_df = bbox_df.loc[cloud_eo_uris]
+
+    # "2019-01-01_2020-12-31" -> "2019-01-01", "2020-12-31"
+    dates = [date_key.partition("_") for date_key in bbox_df["date_key"]]
+    start_dates = np.array([d[0] for d in dates], dtype=str)
+    end_dates = np.array([d[2] for d in dates], dtype=str)
+    paths = np.empty(len(bbox_df), dtype=object)
+    paths[:] = [Path(uri) for uri in bbox_df.index]
+    min_lat = bbox_df["min_lat"].to_numpy(dtype=np.float64)
+    max_lat = bbox_df["max_lat"].to_numpy(dtype=np.float64)
+    min_lon = bbox_df["min_lon"].to_numpy(dtype=np.float64)
+    max_lon = bbox_df["max_lon"].to_numpy(dtype=np.float64)
+    return EOFileBBoxes(
+        paths=paths,
+        start_dates=start_dates,
+        end_dates=end_dates,
+        min_lat=min_lat,
+        max_lat=max_lat,
+        min_lon=min_lon,
+        max_lon=max_lon,
+        tree=shapely.STRtree(shapely.box(min_lon, min_lat, max_lon, max_lat)),
+    )
+
+
+def _match_labels_to_eo_files(labels: pd.DataFrame) -> pd.Series:
+    """
+    Finds the earth observation files which contain each label and cover the label's dates.
+    Candidate files are looked up for all labels at once in the STRtree and then
+    filtered on their date range and on lying within the labels' extent.
+    """
+    shapely = import_optional_dependency("shapely", min_version="2.0")
+    eo = _generate_bbox_from_paths()
+
+    points = shapely.points(labels[LON].to_numpy(), labels[LAT].to_numpy())
+    label_idx, eo_idx = eo.tree.query(points, predicate="intersects")
+
+    # Add a boundary to get additional tifs, as in openmapflow only tifs fully inside
+    # the labels' extent are matched
+    near_labels = (
+        (eo.min_lat >= labels[LAT].min() - 1.0)
+        & (eo.max_lat <= labels[LAT].max() + 1.0)
+        & (eo.min_lon >= labels[LON].min() - 1.0)
+        & (eo.max_lon <= labels[LON].max() + 1.0)
+    )
+
+    # Dates are compared column by column so no joined key is built for every label
+    label_starts = labels[START].to_numpy(dtype=str)
+    label_ends = labels[END].to_numpy(dtype=str)
+    keep = (
+        near_labels[eo_idx]
+        & (eo.start_dates[eo_idx] == label_starts[label_idx])
+        & (eo.end_dates[eo_idx] == label_ends[label_idx])
+    )
+    label_idx, eo_idx = label_idx[keep], eo_idx[keep]
+
+    # Keep the files of each label in their original listing order
+    order = np.lexsort((eo_idx, label_idx))
+    eo_file_paths: List[List[Path]] = [[] for _ in range(len(labels))]
+    for i, j in zip(label_idx[order], eo_idx[order]):
+        eo_file_paths[i].append(eo.paths[j])
+
+    return pd.Series(eo_file_paths, index=labels.index, dtype=object)
+
+
+def _init_ee_api() -> None:
+    # Each worker process needs its own Earth Engine session
+    global ee_api
+    ee_api = EarthEngineAPI()
+
+
+def _is_rate_limited(e: Exception) -> bool:
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and e.response.status_code == 429
+    return "too many" in str(e).lower()
+
+
+def _get_eo_data(
+    i: int, total: int, lat: float, lon: float, start_date: date, end_date: date
+) -> Tuple[Optional[list], Optional[float], Optional[float], str]:
+    """Fetches the earth observation time series for a single label from the Earth Engine API"""
+    if ee_api is None:
+        raise ValueError("Earth Engine API not initialized, call _init_ee_api first")
+    prefix = f"{i}/{total}:"
+    for attempt in range(EE_API_MAX_RETRIES):
+        try:
+            url = ee_api.get_ee_url(lat=lat, lon=lon, start_date=start_date, end_date=end_date)
+            eo_data, eo_lon, eo_lat = _find_matching_point_url(
+                url=url, label_lon=lon, label_lat=lat
+            )
+            break
+        except Exception as e:
+            if not _is_rate_limited(e) or attempt == EE_API_MAX_RETRIES - 1:
+                raise
+            wait = 2**attempt + random.random()
+            print(f"{prefix} rate limited by Earth Engine, retrying in {wait:.1f}s")
+            time.sleep(wait)
+
+    if eo_data is None:
+        print(f"WARNING: {prefix} could not extract data from: {url}")
+        return None, None, None, EO_STATUS_MISSING_VALUES
+    print(f"{prefix} Successfully obtained earth observation data")
+    return eo_data.tolist(), eo_lat, eo_lon, EO_STATUS_COMPLETE
+
+
+def _first_valid(values: np.ndarray, cuts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """First non-null value of each group of sorted values, like groupby().first()"""
+    positions = np.where(pd.notnull(values), np.arange(len(values)), len(values))
+    first = np.minimum.reduceat(positions, cuts) if len(cuts) > 0 else positions[:0]
+    return pd.Series(values).reindex(first).where(first < ends).to_numpy()
+
+
+def _join_groups(values: np.ndarray, group_ids: np.ndarray) -> np.ndarray:
+    """Comma joined str values of each group of sorted values, like agg(",".join)"""
+    if len(values) == 0:
+        return values.astype(object)
+    cuts = np.flatnonzero(np.diff(group_ids, prepend=-1))
+    # Every value but the last of its group is followed by a comma, then the
+    # strings of each group are concatenated by reduceat in a single call
+    sep = np.full(len(values), ",", dtype=object)
+    sep[np.append(cuts[1:], len(values)) - 1] = ""
+    return np.add.reduceat(values.astype(object) + sep, cuts)
+
+
+def _join_unique(values: np.ndarray, group_ids: np.ndarray) -> np.ndarray:
+    """
+    Comma joined unique values of each group in order of appearance, like agg("unique").
+    Values which are already comma joined are split first, so merging combined labels
+    again does not repeat a value.
+    """
+    split = pd.Series(values, index=group_ids, dtype=object).str.split(",").explode()
+    keep = ~pd.DataFrame({"group": split.index, "value": split.to_numpy()}).duplicated().to_numpy()
+    return _join_groups(split.to_numpy()[keep], split.index.to_numpy()[keep])
+
+
+def _join_if_all_str(values: np.ndarray, cuts: np.ndarray, group_ids: np.ndarray) -> np.ndarray:
+    """
+    Comma joined values of each group, or None if any value in the group is not a str.
+    None (rather than "") keeps a missing value missing when combined labels are merged again.
+    """
+    is_str = np.fromiter((isinstance(v, str) for v in values), dtype=bool, count=len(values))
+    all_str = np.logical_and.reduceat(is_str, cuts) if len(cuts) > 0 else is_str[:0]
+    joined = _join_groups(np.where(is_str, values, ""), group_ids)
+    joined[~all_str] = None
+    return joined
+
+
+def _combine_duplicate_labels(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Combines labels with the same coordinates and dates into a single label.
+    Rows are sorted once by group and every column is reduced over contiguous
+    group slices instead of calling a Python function per group.
+    Rows which were already combined are weighted by their NUM_LABELERS (other rows
+    count once), so labels can be merged in one file at a time with the same result.
+    """
+    keys = [LON, LAT, START, END]
+    df = df.dropna(subset=keys)
+
+    # Groups are numbered in order of first appearance, like groupby(sort=False)
+    group_ids = df.groupby(keys, sort=False).ngroup().to_numpy()
+    order = np.argsort(group_ids, kind="stable")
+    group_ids = group_ids[order]
+    cuts = np.flatnonzero(np.diff(group_ids, prepend=-1))
+    ends = np.append(cuts[1:], len(group_ids))
+
+    def sorted_values(col: str) -> np.ndarray:
+        return df[col].to_numpy()[order]
+
+    class_prob = sorted_values(CLASS_PROB).astype(np.float64)
+    if NUM_LABELERS in df.columns:
+        weights = df[NUM_LABELERS].fillna(1).to_numpy(dtype=np.int64)[order]
+    else:
+        weights = np.ones(len(df), dtype=np.int64)
+    num_labelers = np.add.reduceat(weights, cuts) if len(cuts) > 0 else weights[:0]
+    combined = {col: sorted_values(col)[cuts] for col in keys}
+    combined[SOURCE] = _join_unique(sorted_values(SOURCE), group_ids)
+    combined[CLASS_PROB] = (
+        np.add.reduceat(class_prob * weights, cuts) / num_labelers
+        if len(cuts) > 0
+        else class_prob[:0]
+    )
+    combined[NUM_LABELERS] = num_labelers
+    combined[SUBSET] = _first_valid(sorted_values(SUBSET), cuts, ends)
+    for col in [LABEL_DUR, LABELER_NAMES]:
+        combined[col] = _join_if_all_str(sorted_values(col), cuts, group_ids)
+    for col in [EO_DATA, EO_LAT, EO_LON, EO_FILE, EO_STATUS]:
+        combined[col] = _first_valid(sorted_values(col), cuts, ends)
+    return pd.DataFrame(combined)
 
 
 @dataclass
@@ -52,47 +357,29 @@ class CustomLabeledDataset(LabeledDataset):
         Creates a single processed labels file from a list of raw labels.
         """
         df = pd.DataFrame({})
-        already_processed = []
+        already_processed: Set[str] = set()
         if self.df_path.exists():
-            df = pd.read_csv(self.df_path)
-            already_processed = df[SOURCE].unique()
+            df = _read_labels(self.df_path)
+            # Combined labels list every source they came from, separated by commas
+            already_processed = set(",".join(df[SOURCE].unique()).split(","))
 
-        new_labels: List[pd.DataFrame] = []
         raw_year_files = [(p.filename, p.start_year) for p in self.raw_labels]
         if len(raw_year_files) != len(set(raw_year_files)):
             raise ValueError(f"Duplicate raw files found in: {raw_year_files}")
+        new_labels = False
         for p in self.raw_labels:
-            if p.filename not in str(already_processed):
-                new_labels.append(p.process(self.raw_dir))
+            if p.filename not in already_processed:
+                # Each raw file is merged in as soon as it is processed, so only the
+                # combined labels are held in memory instead of every raw file at once.
+                # The combined labels are grouped again for every raw file, so this costs
+                # O(raw files x unique labels), which is small for the few files per dataset
+                df = _combine_duplicate_labels(pd.concat([df, p.process(self.raw_dir)]))
+                new_labels = True
 
-        if len(new_labels) == 0:
+        if not new_labels:
             return df
 
-        df = pd.concat([df] + new_labels)
-
-        # Combine duplicate labels
-        df[NUM_LABELERS] = 1
-
-        def join_if_exists(values):
-            if all((isinstance(v, str) for v in values)):
-                return ",".join(values)
-            return ""
-
-        df = df.groupby([LON, LAT, START, END], as_index=False, sort=False).agg(
-            {
-                SOURCE: lambda sources: ",".join(sources.unique()),
-                CLASS_PROB: "mean",
-                NUM_LABELERS: "sum",
-                SUBSET: "first",
-                LABEL_DUR: join_if_exists,
-                LABELER_NAMES: join_if_exists,
-                EO_DATA: "first",
-                EO_LAT: "first",
-                EO_LON: "first",
-                EO_FILE: "first",
-                EO_STATUS: "first",
-            }
-        )
+        df[[LABEL_DUR, LABELER_NAMES]] = df[[LABEL_DUR, LABELER_NAMES]].fillna("")
         df[COUNTRY] = self.country
         df[DATASET] = self.name
         df.loc[df[CLASS_PROB] == 0.5, EO_STATUS] = EO_STATUS_SKIPPED
@@ -101,6 +388,165 @@ class CustomLabeledDataset(LabeledDataset):
         df.to_csv(self.df_path, index=False)
         return df
 
+    def _fetch_eo_data_with_ee_tasks(
+        self, df: pd.DataFrame, no_eo: pd.Series, interactive: bool = False
+    ) -> pd.DataFrame:
+        """
+        Same as LabeledDataset._fetch_eo_data_with_ee_tasks but labels are matched to
+        earth observation files with the STRtree based _match_labels_to_eo_files and
+        duplicate earth observation coordinates are found with a set lookup.
+        """
+
+        # STEP 1: Match labels to earth observation files
+        # The labels without earth observation data are selected once and the matches are
+        # kept alongside them instead of being written into df and selected again
+        labels = df[no_eo]
+        matching_eo_files = _match_labels_to_eo_files(labels)
+
+        eo_files_found = matching_eo_files.str.len() > 0
+        df_with_no_eo_files = labels.loc[~eo_files_found]
+        df_with_eo_files = labels.loc[eo_files_found]
+
+        # STEP 2: If no matching earth observation file, download it
+        already_getting_eo = df_with_no_eo_files[EO_STATUS] == EO_STATUS_EXPORTING
+        if interactive and already_getting_eo.sum() > 0:
+            confirm = (
+                input(
+                    f"{already_getting_eo.sum()} labels were already set to {EO_STATUS_EXPORTING} ,"
+                    + " have they failed on EarthEngine? y/[n]: "
+                )
+                or "n"
+            )
+            if confirm.lower() == "y":
+                df.loc[already_getting_eo.index, EO_STATUS] = EO_STATUS_EXPORT_FAILED
+                df_with_no_eo_files = df_with_no_eo_files.loc[~already_getting_eo]
+
+        if len(df_with_no_eo_files) > 0:
+            print(f"{len(df_with_no_eo_files)} labels not matched")
+            EarthEngineExporter(
+                check_ee=True, check_gcp=True, dest_bucket=BucketNames.LABELED_EO
+            ).export_for_labels(labels=df_with_no_eo_files)
+            df.loc[df_with_no_eo_files.index, EO_STATUS] = EO_STATUS_EXPORTING
+
+        # STEP 3: Create the dataset (earth observation data, label)
+        if len(df_with_eo_files) > 0:
+            storage = import_optional_dependency("google.cloud.storage")
+            tif_bucket = storage.Client().bucket(BucketNames.LABELED_EO)
+
+            df[EO_DATA] = df[EO_DATA].astype(object)
+            df[EO_FILE] = df[EO_FILE].astype(str)
+
+            # Earth observation coordinates already assigned to a label, kept as a set so
+            # each lookup is a hash instead of a scan over the whole DataFrame
+            used_eo_points = set(zip(df[EO_FILE], df[EO_LAT], df[EO_LON]))
+
+            def set_df(i, eo_paths, lon, lat, pbar):
+                eo_data, eo_lon, eo_lat, eo_file = _find_matching_point(
+                    eo_paths=eo_paths,
+                    label_lon=lon,
+                    label_lat=lat,
+                    tif_bucket=tif_bucket,
+                )
+                pbar.update(1)
+                if eo_data is None:
+                    print(
+                        "Earth observation file could not be loaded, "
+                        + f"setting status to: {EO_STATUS_MISSING_VALUES}"
+                    )
+                    df.at[i, EO_STATUS] = EO_STATUS_MISSING_VALUES
+                elif (eo_file, eo_lat, eo_lon) in used_eo_points:
+                    print(
+                        "Earth observation coordinate already used, "
+                        + f"setting status to {EO_STATUS_DUPLICATE}"
+                    )
+                    df.at[i, EO_STATUS] = EO_STATUS_DUPLICATE
+                else:
+                    df.at[i, EO_DATA] = eo_data.tolist()
+                    df.at[i, EO_LAT] = eo_lat
+                    df.at[i, EO_LON] = eo_lon
+                    df.at[i, EO_FILE] = eo_file
+                    df.at[i, EO_STATUS] = EO_STATUS_COMPLETE
+                    used_eo_points.add((eo_file, eo_lat, eo_lon))
+                return True
+
+            with tqdm(
+                total=len(df_with_eo_files), desc="Extracting matched earth observation data"
+            ) as pbar:
+                np.vectorize(set_df, otypes="b")(
+                    i=df_with_eo_files.index,
+                    eo_paths=matching_eo_files.loc[eo_files_found],
+                    lon=df_with_eo_files[LON],
+                    lat=df_with_eo_files[LAT],
+                    pbar=pbar,
+                )
+        return df
+
+    def _fetch_eo_data_with_ee_api(
+        self, df: pd.DataFrame, npartitions: int = EE_API_PROCESSES
+    ) -> pd.DataFrame:
+        """
+        Fetch earth observation data for labels without earth observation data using
+        the high volume Earth Engine API. Requests are sent from a pool of processes
+        (npartitions) and retried with backoff when rate limited.
+        """
+        no_eo = clean_df_condition(df) & (df[EO_DATA].isnull())
+        labels = df[no_eo]
+        total = len(labels)
+        label_args = zip(
+            range(total),
+            [total] * total,
+            labels[LAT],
+            labels[LON],
+            pd.to_datetime(labels[START]),
+            pd.to_datetime(labels[END]),
+        )
+
+        with multiprocessing.Pool(npartitions, initializer=_init_ee_api) as pool:
+            out = pool.starmap(_get_eo_data, label_args)
+
+        df[EO_DATA] = df[EO_DATA].astype(object)
+        if total > 0:
+            eo_data, eo_lat, eo_lon, eo_status = zip(*out)
+            df.loc[no_eo, EO_DATA] = pd.Series(eo_data, index=labels.index, dtype=object)
+            df.loc[no_eo, EO_LAT] = eo_lat
+            df.loc[no_eo, EO_LON] = eo_lon
+            df.loc[no_eo, EO_STATUS] = eo_status
+        return df
+
+    def create_dataset(
+        self, ee_api: bool = False, interactive: bool = True, npartitions: int = EE_API_PROCESSES
+    ) -> str:
+        """
+        Same as LabeledDataset.create_dataset but the labels csv is read with a fixed
+        column schema. create_datasets does not pass npartitions, so the default here
+        sets the Earth Engine API pool size.
+        """
+
+        # Load the labels
+        if not self.df_path.exists():
+            df = self.load_labels()
+            df = self._verify_and_standardize_df(df)
+            df.to_csv(self.df_path, index=False)
+        df = _read_labels(self.df_path)
+
+        # Check if earth observation data is already present
+        no_eo = clean_df_condition(df) & (df[EO_DATA].isnull())
+        if no_eo.sum() == 0:
+            df = self._mark_duplicates(df)
+            return self.summary(df)
+
+        # Fetch the earth observation data
+        print(self.summary(df))
+        if ee_api:
+            df = self._fetch_eo_data_with_ee_api(df, npartitions=npartitions)
+        else:
+            df = self._fetch_eo_data_with_ee_tasks(df, no_eo, interactive=interactive)
+        df = self._mark_duplicates(df)
+
+        # Save the dataset
+        df.to_csv(self.df_path, index=False)
+        return self.summary(df)
+
     def summary(self, df: pd.DataFrame) -> str:
         timesteps = get_label_timesteps(df).unique()
         eo_status_str = str(df[EO_STATUS].value_counts()).rsplit("\n", 1)[0]
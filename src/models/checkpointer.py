@@ -0,0 +1,97 @@
+import os
+import queue
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional, Set, Tuple
+
+import torch
+
+
+class AsyncCheckpointer:
+    """
+    Saves checkpoints from a background thread so training does not block on disk writes.
+
+    Tensors are copied into CPU staging buffers (pinned when CUDA is available) which are
+    reused across saves, then a worker thread writes the staged checkpoint with torch.save.
+    Call finalize() at the end of training to wait for the last checkpoint to be written.
+    """
+
+    def __init__(self) -> None:
+        self._queue: "queue.Queue[Optional[Tuple[Any, Path, Any]]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._buffers: Dict[Tuple, torch.Tensor] = {}
+        self._error: Optional[BaseException] = None
+        self.submitted: Set[Path] = set()
+
+    def _worker(self) -> None:
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                checkpoint, filepath, copy_done = item
+                if copy_done is not None:
+                    copy_done.synchronize()
+                # Same atomic write as pytorch_lightning's Trainer._atomic_save
+                tmp_path = str(filepath) + ".part"
+                torch.save(checkpoint, tmp_path)
+                os.replace(tmp_path, filepath)
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _stage(self, obj: Any, key: Tuple) -> Any:
+        if isinstance(obj, torch.Tensor):
+            buffer = self._buffers.get(key)
+            if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+                buffer = torch.empty(
+                    obj.shape, dtype=obj.dtype, pin_memory=torch.cuda.is_available()
+                )
+                self._buffers[key] = buffer
+            buffer.copy_(obj.detach(), non_blocking=True)
+            return buffer
+        # Containers are rebuilt so later changes during training don't leak into the file
+        if isinstance(obj, dict):
+            staged = obj.__class__((k, self._stage(v, key + (k,))) for k, v in obj.items())
+            # state_dict versions are kept as an attribute of the OrderedDict
+            if hasattr(obj, "_metadata"):
+                setattr(staged, "_metadata", getattr(obj, "_metadata"))
+            return staged
+        if isinstance(obj, (list, tuple)):
+            return obj.__class__(self._stage(v, key + (i,)) for i, v in enumerate(obj))
+        return obj
+
+    def _raise_if_failed(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Asynchronous checkpoint save failed") from error
+
+    def wait(self) -> None:
+        """Blocks until all submitted checkpoints have been written."""
+        self._queue.join()
+        self._raise_if_failed()
+
+    def save(self, checkpoint: Dict[str, Any], filepath: Path) -> None:
+        # The staging buffers are shared, so the previous write must finish first
+        self.wait()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker, daemon=True)
+            self._thread.start()
+
+        staged = self._stage(checkpoint, ())
+        copy_done = None
+        if torch.cuda.is_available():
+            copy_done = torch.cuda.Event()
+            copy_done.record()
+        self.submitted.add(filepath)
+        self._queue.put((staged, filepath, copy_done))
+
+    def finalize(self) -> None:
+        """Waits for pending writes and stops the worker thread."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._buffers.clear()
+        self._raise_if_failed()
@@ -25,6 +25,7 @@ from torch.utils.data import DataLoader
 from datasets import datasets
 from src.bboxes import bboxes
 
+from .checkpointer import AsyncCheckpointer
 from .classifier import Classifier
 from .data import CropDataset
 from .forecaster import Forecaster
@@ -78,6 +79,9 @@ class Model(pl.LightningModule):
 
         self.hparams = hparams
 
+        # Set by train_model to save checkpoints without blocking training
+        self.checkpointer: Optional[AsyncCheckpointer] = None
+
         self.batch_size = hparams.batch_size
 
         if "bbox" in hparams:
@@ -500,13 +504,19 @@ class Model(pl.LightningModule):
 
         # Save model with lowest validation loss
         model_ckpt_path = PROJECT_ROOT / DataPaths.MODELS / f"{self.hparams.model_name}.ckpt"
+        ckpt_saved = model_ckpt_path.exists() or (
+            self.checkpointer is not None and model_ckpt_path in self.checkpointer.submitted
+        )
         save_model_condition = self.current_epoch > 0 and (
-            not model_ckpt_path.exists() or (self.val_losses[-1] == min(self.val_losses[1:]))
+            not ckpt_saved or (self.val_losses[-1] == min(self.val_losses[1:]))
         )
         if save_model_condition:
             saved_metrics = {f"{k}_saved": v for k, v in metrics.items()}
             logs.update(saved_metrics)
-            self.trainer.save_checkpoint(model_ckpt_path)
+            if self.checkpointer is not None:
+                self.checkpointer.save(self.trainer.dump_checkpoint(), model_ckpt_path)
+            else:
+                self.trainer.save_checkpoint(model_ckpt_path)
         return {"log": logs}
 
     def test_epoch_end(self, outputs):
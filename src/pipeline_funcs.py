@@ -1,8 +1,9 @@
-import json
+import os
 from argparse import Namespace
 from pathlib import Path
 from typing import Any, Dict, Optional, Tuple
 
+import orjson
 import pytorch_lightning as pl
 from openmapflow.config import PROJECT_ROOT, DataPaths
 from pytorch_lightning.callbacks import EarlyStopping
@@ -11,6 +12,7 @@ from tqdm import tqdm
 
 from datasets import datasets
 from src.models import Model
+from src.models.checkpointer import AsyncCheckpointer
 
 all_dataset_names = [d.name for d in datasets]
 
@@ -72,7 +74,11 @@ def train_model(
         logger=wandb_logger if hparams.wandb else False,
     )
 
-    trainer.fit(model)
+    model.checkpointer = AsyncCheckpointer()
+    try:
+        trainer.fit(model)
+    finally:
+        model.checkpointer.finalize()
 
     model_ckpt_path = PROJECT_ROOT / DataPaths.MODELS / f"{hparams.model_name}.ckpt"
     if not model_ckpt_path.exists():
@@ -106,6 +112,23 @@ def run_evaluation_on_one_model(model: Model, test: bool = False) -> Dict[str, f
     return metrics
 
 
+def _save_metrics(new_model_metrics: Dict[str, Dict[str, Any]]) -> None:
+    metrics_path = PROJECT_ROOT / DataPaths.METRICS
+    models_dict = orjson.loads(metrics_path.read_bytes())
+
+    models_dict.update(new_model_metrics)
+
+    # Write to a temporary file and swap it in so readers never see a partial file
+    tmp_path = metrics_path.with_suffix(".json.tmp")
+    tmp_path.write_bytes(
+        orjson.dumps(
+            models_dict,
+            option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS | orjson.OPT_APPEND_NEWLINE,
+        )
+    )
+    os.replace(tmp_path, metrics_path)
+
+
 def run_evaluation(
     model_ckpt_path: Path, alternative_threshold: Optional[float] = None
 ) -> Tuple[Any, Dict[str, Dict[str, Any]]]:
@@ -121,18 +144,11 @@ def run_evaluation(
         for k, v in alternative_metrics.items():
             val_metrics[f"thresh{alternative_threshold}_{k}"] = v
 
-    with (PROJECT_ROOT / DataPaths.METRICS).open() as f:
-        models_dict = json.load(f)
-
     all_info = {
         "params": model.hparams.wandb_url,
         "val_metrics": val_metrics,
         "test_metrics": test_metrics,
     }
-    models_dict[model.hparams.model_name] = all_info
-
-    with (PROJECT_ROOT / DataPaths.METRICS).open("w") as f:
-        json.dump(models_dict, f, ensure_ascii=False, indent=4, sort_keys=True)
-        f.write("\n")
+    _save_metrics({model.hparams.model_name: all_info})
 
     return model, all_info
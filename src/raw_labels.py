@@ -108,8 +108,9 @@ def _set_start_end_dates(
 
     df = df[df[START] < df[END]].copy()
 
-    df[START] = pd.to_datetime(df[START]).dt.strftime("%Y-%m-%d")
-    df[END] = pd.to_datetime(df[END]).dt.strftime("%Y-%m-%d")
+    # Formatted by numpy in C rather than with one strftime call per row
+    df[START] = np.datetime_as_string(pd.to_datetime(df[START]).to_numpy(), unit="D")
+    df[END] = np.datetime_as_string(pd.to_datetime(df[END]).to_numpy(), unit="D")
     return df
 
 
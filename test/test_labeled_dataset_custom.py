@@ -0,0 +1,266 @@
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+
+try:
+    import openmapflow.labeled_dataset as omf_labeled_dataset
+    import shapely  # noqa
+    from openmapflow.constants import (
+        CLASS_PROB,
+        END,
+        EO_DATA,
+        EO_FILE,
+        EO_LAT,
+        EO_LON,
+        EO_STATUS,
+        EO_STATUS_WAITING,
+        LABEL_DUR,
+        LABELER_NAMES,
+        LAT,
+        LON,
+        NUM_LABELERS,
+        SOURCE,
+        START,
+        SUBSET,
+    )
+
+    import src.labeled_dataset_custom as labeled_dataset_custom
+
+    DEPS_INSTALLED = True
+except ImportError:
+    DEPS_INSTALLED = False
+
+
+def _tif_uri(min_lat, min_lon, max_lat, max_lon, start="2019-01-01", end="2020-12-31"):
+    return (
+        f"gs://bucket/min_lat={min_lat}_min_lon={min_lon}_max_lat={max_lat}_max_lon={max_lon}"
+        + f"_dates={start}_{end}_all.tif"
+    )
+
+
+class TestMatchLabelsToEOFiles(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        if DEPS_INSTALLED:
+            labeled_dataset_custom._generate_bbox_from_paths.cache_clear()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        if DEPS_INSTALLED:
+            labeled_dataset_custom._generate_bbox_from_paths.cache_clear()
+
+    def _match(self, labels: pd.DataFrame, uris):
+        """Returns the matches of openmapflow and of labeled_dataset_custom"""
+        cache_path = Path(self.tmpdir.name) / "eo_bboxes.csv"
+        with patch.object(
+            omf_labeled_dataset, "get_cloud_tif_list", return_value=uris
+        ), patch.object(
+            labeled_dataset_custom, "get_cloud_tif_list", return_value=uris
+        ), patch.object(
+            labeled_dataset_custom, "eo_bboxes_cache_path", cache_path
+        ):
+            expected = omf_labeled_dataset._match_labels_to_eo_files(labels)
+            actual = labeled_dataset_custom._match_labels_to_eo_files(labels)
+        return [list(paths) for paths in expected], [list(paths) for paths in actual]
+
+    @skipIf(not DEPS_INSTALLED, reason="No openmapflow or shapely installed")
+    def test_tif_outside_labels_extent_not_matched(self):
+        labels = pd.DataFrame({LAT: [0.0], LON: [0.0], START: ["2019-01-01"], END: ["2020-12-31"]})
+        expected, actual = self._match(labels, [_tif_uri(-1.5, -1.5, 1.5, 1.5)])
+        self.assertEqual(expected, [[]])
+        self.assertEqual(actual, expected)
+
+    @skipIf(not DEPS_INSTALLED, reason="No openmapflow or shapely installed")
+    def test_matches_openmapflow(self):
+        labels = pd.DataFrame(
+            {
+                LAT: [0.0, 0.2, 2.0, 0.5, 10.0],
+                LON: [0.0, 0.2, 2.0, 0.5, 10.0],
+                START: ["2019-01-01"] * 4 + ["2018-01-01"],
+                END: ["2020-12-31"] * 4 + ["2019-12-31"],
+            },
+            index=[3, 1, 4, 5, 9],
+        )
+        uris = [
+            _tif_uri(-0.5, -0.5, 0.5, 0.5),
+            _tif_uri(0.1, 0.1, 1.1, 1.1),
+            _tif_uri(-0.5, -0.5, 0.5, 0.5, start="2018-01-01", end="2019-12-31"),
+            _tif_uri(1.5, 1.5, 2.5, 2.5),
+            _tif_uri(-1.5, -1.5, 1.5, 1.5),
+            _tif_uri(9.5, 9.5, 10.5, 10.5, start="2018-01-01", end="2019-12-31"),
+            _tif_uri(9.5, 9.5, 11.5, 11.5, start="2018-01-01", end="2019-12-31"),
+        ]
+        expected, actual = self._match(labels, uris)
+        self.assertEqual(actual, expected)
+        self.assertEqual([len(paths) for paths in actual], [1, 2, 1, 2, 1])
+
+
+def _raw_labels(source, lon, lat, class_prob, start="2019-01-01", labeler_names=None):
+    """Labels as returned by RawLabels.process for a single raw file"""
+    n = len(lon)
+    return pd.DataFrame(
+        {
+            SOURCE: source,
+            CLASS_PROB: class_prob,
+            START: start,
+            END: "2020-12-31",
+            LON: lon,
+            LAT: lat,
+            SUBSET: ["training", "validation", "testing"] * (n // 3) + ["training"] * (n % 3),
+            LABELER_NAMES: labeler_names,
+            LABEL_DUR: [f"{i}.0" for i in range(n)] if labeler_names is not None else None,
+            EO_DATA: None,
+            EO_LAT: None,
+            EO_LON: None,
+            EO_FILE: None,
+            EO_STATUS: EO_STATUS_WAITING,
+        }
+    )
+
+
+class TestCombineDuplicateLabels(TestCase):
+    @skipIf(not DEPS_INSTALLED, reason="No openmapflow or shapely installed")
+    def test_first_valid_skips_nulls(self):
+        values = np.array([None, "a", "b", np.nan, None, "c"], dtype=object)
+        cuts, ends = np.array([0, 3, 5]), np.array([3, 5, 6])
+        first = labeled_dataset_custom._first_valid(values, cuts, ends)
+        self.assertEqual(first[0], "a")
+        self.assertTrue(pd.isnull(first[1]))
+        self.assertEqual(first[2], "c")
+
+    @skipIf(not DEPS_INSTALLED, reason="No openmapflow or shapely installed")
+    def test_join_if_all_str_with_nulls(self):
+        values = np.array(["a", "b", None, "c", np.nan, "d"], dtype=object)
+        group_ids = np.array([0, 0, 1, 1, 2, 3])
+        cuts = np.array([0, 2, 4, 5])
+        joined = labeled_dataset_custom._join_if_all_str(values, cuts, group_ids)
+        self.assertEqual(list(joined), ["a,b", None, None, "d"])
+
+    @skipIf(not DEPS_INSTALLED, reason="No openmapflow or shapely installed")
+    def test_combine_empty(self):
+        df = _raw_labels("a.csv", lon=[], lat=[], class_prob=[])
+        combined = labeled_dataset_custom._combine_duplicate_labels(df)
+        self.assertEqual(len(combined), 0)
+        self.assertEqual(set(combined.columns), set(df.columns) | {NUM_LABELERS})
+
+    @skipIf(not DEPS_INSTALLED, reason="No openmapflow or shapely installed")
+    def test_combine_duplicates(self):
+        df = _raw_labels(
+            "a.csv",
+            lon=[1.0, 2.0, 1.0, np.nan],
+            lat=[1.0, 2.0, 1.0, 3.0],
+            class_prob=[1.0, 0.0, 0.0, 1.0],
+            labeler_names=["x", "y", None, "z"],
+        )
+        combined = labeled_dataset_custom._combine_duplicate_labels(df)
+        self.assertEqual(combined[LON].tolist(), [1.0, 2.0])
+        self.assertEqual(combined[CLASS_PROB].tolist(), [0.5, 0.0])
+        self.assertEqual(combined[NUM_LABELERS].tolist(), [2, 1])
+        self.assertEqual(combined[SOURCE].tolist(), ["a.csv", "a.csv"])
+        self.assertEqual(combined[SUBSET].tolist(), ["training", "validation"])
+        self.assertTrue(pd.isnull(combined[LABELER_NAMES][0]))
+        self.assertEqual(combined[LABELER_NAMES][1], "y")
+        self.assertEqual(combined[EO_STATUS].tolist(), [EO_STATUS_WAITING] * 2)
+
+
+def _combine_with_groupby_agg(df: pd.DataFrame) -> pd.DataFrame:
+    """The groupby().agg load_labels used to combine all raw labels at once"""
+    df = df.copy()
+    df[NUM_LABELERS] = 1
+
+    def join_if_exists(values):
+        if all((isinstance(v, str) for v in values)):
+            return ",".join(values)
+        return ""
+
+    return df.groupby([LON, LAT, START, END], as_index=False, sort=False).agg(
+        {
+            SOURCE: lambda sources: ",".join(sources.unique()),
+            CLASS_PROB: "mean",
+            NUM_LABELERS: "sum",
+            SUBSET: "first",
+            LABEL_DUR: join_if_exists,
+            LABELER_NAMES: join_if_exists,
+            EO_DATA: "first",
+            EO_LAT: "first",
+            EO_LON: "first",
+            EO_FILE: "first",
+            EO_STATUS: "first",
+        }
+    )
+
+
+@dataclass
+class _StubRawLabels:
+    filename: str
+    labels: pd.DataFrame
+    start_year: int = 2019
+
+    def process(self, raw_folder: Path) -> pd.DataFrame:
+        return self.labels
+
+
+class TestLoadLabels(TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.raw_files = []
+        for i in range(3):
+            n = 60
+            self.raw_files.append(
+                _raw_labels(
+                    f"{i}.csv",
+                    lon=rng.integers(0, 8, n).astype(float),
+                    lat=rng.integers(0, 4, n).astype(float),
+                    class_prob=rng.integers(0, 2, n).astype(float),
+                    start=rng.choice(["2019-01-01", "2020-01-01"], n),
+                    labeler_names=[f"labeler{j % 5}" for j in range(n)] if i != 1 else None,
+                )
+            )
+
+    @skipIf(not DEPS_INSTALLED, reason="No openmapflow or shapely installed")
+    def test_combine_matches_groupby_agg(self):
+        df = pd.concat(self.raw_files)
+        expected = _combine_with_groupby_agg(df)
+        actual = labeled_dataset_custom._combine_duplicate_labels(df)[expected.columns]
+        actual[[LABEL_DUR, LABELER_NAMES]] = actual[[LABEL_DUR, LABELER_NAMES]].fillna("")
+        # Groups without any value are NaN rather than None, both are written as an empty cell
+        pd.testing.assert_frame_equal(
+            actual.mask(actual.isnull()), expected.mask(expected.isnull()), check_dtype=False
+        )
+
+    @skipIf(not DEPS_INSTALLED, reason="No openmapflow or shapely installed")
+    def test_combine_file_by_file_matches_batch(self):
+        expected = labeled_dataset_custom._combine_duplicate_labels(pd.concat(self.raw_files))
+        actual = pd.DataFrame({})
+        for raw in self.raw_files:
+            actual = labeled_dataset_custom._combine_duplicate_labels(pd.concat([actual, raw]))
+        pd.testing.assert_frame_equal(actual, expected)
+
+    @skipIf(not DEPS_INSTALLED, reason="No openmapflow or shapely installed")
+    def test_new_labels_weighted_by_existing_num_labelers(self):
+        existing = _raw_labels("a.csv", lon=[1.0, 1.0, 2.0], lat=[1.0, 1.0, 2.0], class_prob=1.0)
+        new = _raw_labels("b.csv", lon=[1.0, 2.0], lat=[1.0, 2.0], class_prob=0.0)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dataset = labeled_dataset_custom.CustomLabeledDataset(
+                dataset="test",
+                country="test",
+                raw_labels=(_StubRawLabels("a.csv", existing),),
+            )
+            dataset.df_path = Path(tmpdir) / "test.csv"
+            dataset.load_labels()
+
+            dataset.raw_labels = (
+                _StubRawLabels("a.csv", existing),
+                _StubRawLabels("b.csv", new),
+            )
+            df = dataset.load_labels()
+
+        # (1.0, 1.0) was labeled twice in a.csv, so the a.csv label counts twice
+        self.assertEqual(df[NUM_LABELERS].tolist(), [3, 2])
+        self.assertEqual(df[CLASS_PROB].tolist(), [2 / 3, 0.5])
+        self.assertEqual(df[SOURCE].tolist(), ["a.csv,b.csv"] * 2)
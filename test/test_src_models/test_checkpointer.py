@@ -0,0 +1,43 @@
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+from unittest import TestCase, skipIf
+
+try:
+    import torch
+
+    from src.models.checkpointer import AsyncCheckpointer
+
+    TORCH_INSTALLED = True
+except ImportError:
+    TORCH_INSTALLED = False
+
+
+class TestAsyncCheckpointer(TestCase):
+    @skipIf(not TORCH_INSTALLED, reason="No torch installed")
+    def test_save_is_snapshot(self):
+        weight = torch.tensor([1.0, 2.0])
+        state_dict = OrderedDict(weight=weight)
+        hparams = {"model_name": "a"}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "model.ckpt"
+            checkpointer = AsyncCheckpointer()
+            checkpointer.save({"state_dict": state_dict, "hparams": hparams}, path)
+            # Changes made after save returns must not end up in the checkpoint
+            weight.add_(1.0)
+            hparams["model_name"] = "b"
+            checkpointer.finalize()
+
+            self.assertIn(path, checkpointer.submitted)
+            checkpoint = torch.load(path)
+            self.assertTrue(
+                torch.equal(checkpoint["state_dict"]["weight"], torch.tensor([1.0, 2.0]))
+            )
+            self.assertEqual(checkpoint["hparams"], {"model_name": "a"})
+
+    @skipIf(not TORCH_INSTALLED, reason="No torch installed")
+    def test_failed_save_raises(self):
+        checkpointer = AsyncCheckpointer()
+        checkpointer.save({"epoch": 1}, Path("/nonexistent_dir/model.ckpt"))
+        with self.assertRaises(RuntimeError):
+            checkpointer.finalize()
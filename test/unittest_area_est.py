@@ -9,6 +9,7 @@ if module_path not in sys.path:
     sys.path.append(module_path)
 
 from src.area_utils import (  # noqa: E402
+    ConfusionStats,
     compute_acc,
     compute_area_error_matrix,
     compute_area_estimate,
@@ -145,6 +146,23 @@ class ChangeAreaTest(unittest.TestCase):
             verbose=True,
         )
 
+    def test_confusion_stats(self):
+        stats = ConfusionStats(self.cm)
+        np.testing.assert_array_equal(stats.col_sum, self.cm.sum(axis=0))
+        np.testing.assert_array_equal(stats.row_sum, self.cm.sum(axis=1))
+        np.testing.assert_array_equal(stats.diag, np.diag(self.cm))
+        self.assertEqual(stats.total, self.cm.sum())
+
+        # Functions give the same results for a matrix and its precomputed stats
+        np.testing.assert_array_equal(
+            compute_area_error_matrix(stats, self.w_j),
+            compute_area_error_matrix(self.cm, self.w_j),
+        )
+        np.testing.assert_array_equal(compute_u_j(ConfusionStats(self.am)), compute_u_j(self.am))
+        np.testing.assert_array_equal(
+            compute_var_u_j(self.u_j, stats), compute_var_u_j(self.u_j, self.cm)
+        )
+
     def test_compute_area_estimate(self):
         estimates = compute_area_estimate(self.cm, self.a_j, px_size=30)
         u_j, err_u_j = estimates["user"]